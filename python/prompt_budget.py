@@ -0,0 +1,41 @@
+"""
+Print the token count of every static prompt prefix in story_engine.
+
+Run after editing a prompt to check it did not grow:
+    python python/prompt_budget.py
+
+Exits non-zero if any prefix is over its budget.
+"""
+import sys
+
+import story_engine as se
+
+# (prefix, model that receives it, token budget) – token counts depend on the
+# model's tokenizer. Budgets leave ~10% headroom over the current prompts.
+PREFIXES = {
+    "STATIC_GENERATE_PREFIX": (se.STATIC_GENERATE_PREFIX, se.MODEL_WRITER, 320),
+    "STATIC_JUDGE_PREFIX": (se.STATIC_JUDGE_PREFIX, se.MODEL_JUDGE, 400),
+    "STATIC_REVISE_PREFIX": (se.STATIC_REVISE_PREFIX, se.MODEL_WRITER, 210),
+    "STATIC_JUDGE_AND_REVISE_PREFIX": (se.STATIC_JUDGE_AND_REVISE_PREFIX, se.MODEL_WRITER, 450),
+    "STATIC_FEEDBACK_PREFIX": (se.STATIC_FEEDBACK_PREFIX, se.MODEL_WRITER, 64),
+    "moral safety prompt": (se._moral_safety_prompt("", 0), se.MODEL_CLASSIFIER, 128),
+}
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(se._encoding_for(model).encode(text))
+
+
+def main() -> int:
+    over_budget = []
+    for name, (text, model, budget) in PREFIXES.items():
+        tokens = count_tokens(text, model)
+        flag = "  OVER BUDGET" if tokens > budget else ""
+        print(f"{name:<32} {tokens:>5} / {budget:>5} tokens  ({model}){flag}")
+        if tokens > budget:
+            over_budget.append(name)
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,29 @@
+import argparse
+import array
+import asyncio
+import functools
+import hashlib
+import httpx
+import json
+import math
 import os
 import openai
 import random
+import re
+import sqlite3
+import sys
+import threading
+import tiktoken
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson, when installed, parses the judge verdicts and batch results several
+# times faster than the stdlib; both accept str input.
+json_loads = orjson.loads if orjson is not None else json.loads
 
 """
 Need to make the block diagram
@@ -13,20 +36,207 @@ YouTube demo Dreamweaver MVP
 # --------------------------------------------------------
 # Basic model wrapper (same model as skeleton – do not change)
 # --------------------------------------------------------
-def call_model(prompt: str, max_tokens: int = 1500, temperature: float = 0.4) -> str:
+MODEL = "gpt-3.5-turbo"
+
+# Per-role models, all the skeleton model by default. Classification and rubric
+# scoring are narrow tasks, so DREAMWEAVER_MODEL_JUDGE / _CLASSIFIER can opt
+# into a smaller, faster model (e.g. gpt-4o-mini) where that is allowed.
+MODEL_WRITER = os.getenv("DREAMWEAVER_MODEL_WRITER", MODEL)
+MODEL_JUDGE = os.getenv("DREAMWEAVER_MODEL_JUDGE", MODEL)
+MODEL_CLASSIFIER = os.getenv("DREAMWEAVER_MODEL_CLASSIFIER", MODEL)
+
+
+@functools.cache
+def _encoding_for(model: str) -> tiktoken.Encoding:
+    # Built on first use: tiktoken downloads encodings it has not cached yet,
+    # which must not happen at import time (offline runs, --help).
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Unknown to this tiktoken version; newer OpenAI models use o200k_base.
+        return tiktoken.get_encoding("o200k_base")
+
+
+# One client per process so the HTTP connection pool (TCP/TLS) is reused
+# across the draft → judge → revise calls instead of reconnecting each time.
+_CLIENT: openai.OpenAI | None = None
+_ACLIENT: openai.AsyncOpenAI | None = None
+
+# Rate limits (429), 5xx and dropped connections are retried by the SDK with
+# jittered exponential backoff, so one transient error late in the pipeline
+# does not throw away the calls already paid for.
+API_MAX_RETRIES = 5
+API_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+API_CONNECTION_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=10)
+
+
+def _api_key() -> str:
     # Please set OPENAI_API_KEY in your environment; do not hard-code it.
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    if not openai.api_key:
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
         raise RuntimeError("Please set the OPENAI_API_KEY environment variable.")
+    return api_key
+
+
+def get_client() -> openai.OpenAI:
+    """Create the shared sync OpenAI client on first use (Batch API jobs only)."""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = openai.OpenAI(
+            api_key=_api_key(),
+            max_retries=API_MAX_RETRIES,
+            timeout=API_TIMEOUT,
+            http_client=openai.DefaultHttpxClient(limits=API_CONNECTION_LIMITS),
+        )
+    return _CLIENT
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """Create the shared async OpenAI client on first use; the CLI uses only this one."""
+    global _ACLIENT
+    if _ACLIENT is None:
+        _ACLIENT = openai.AsyncOpenAI(
+            api_key=_api_key(),
+            max_retries=API_MAX_RETRIES,
+            timeout=API_TIMEOUT,
+            http_client=openai.DefaultAsyncHttpxClient(limits=API_CONNECTION_LIMITS),
+        )
+    return _ACLIENT
 
-    resp = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        stream=False,
-        max_tokens=max_tokens,
-        temperature=temperature,
-    )
-    return resp.choices[0].message["content"]  # type: ignore
+
+# --------------------------------------------------------
+# Response cache for deterministic (near-zero temperature) calls
+# --------------------------------------------------------
+CACHE_PATH = os.getenv("DREAMWEAVER_CACHE_PATH", os.path.expanduser("~/.dreamweaver_cache.sqlite"))
+CACHE_MAX_TEMPERATURE = 0.15
+
+_CACHE_CONN: sqlite3.Connection | None = None
+# The cache wrapper reads and writes from worker threads, so the shared
+# connection is opened for any thread and every use is serialized by this lock.
+_CACHE_LOCK = threading.Lock()
+
+
+def _cache_conn() -> sqlite3.Connection:
+    global _CACHE_CONN
+    if _CACHE_CONN is None:
+        _CACHE_CONN = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _CACHE_CONN.execute("PRAGMA journal_mode=WAL")
+        _CACHE_CONN.execute("CREATE TABLE IF NOT EXISTS cache (k TEXT PRIMARY KEY, resp TEXT NOT NULL)")
+        _CACHE_CONN.execute(
+            "CREATE TABLE IF NOT EXISTS stories ("
+            "id INTEGER PRIMARY KEY, age INTEGER NOT NULL, length_minutes REAL NOT NULL, "
+            "moral TEXT NOT NULL, embedding BLOB NOT NULL, story TEXT NOT NULL, selected_moral TEXT NOT NULL)"
+        )
+    return _CACHE_CONN
+
+
+def _cache_key(prompt: str, max_tokens: int, temperature: float, extra: dict) -> str:
+    # Extra request options (e.g. logit_bias) change the response, so they are keyed too.
+    extra = dict(extra)
+    model = extra.pop("model", MODEL)
+    options = f"{json.dumps(extra, sort_keys=True)}|" if extra else ""
+    return hashlib.sha256(f"{model}|{max_tokens}|{temperature}|{options}{prompt}".encode()).hexdigest()
+
+
+# The cache is an optimization: an unopenable or locked database is treated as
+# a miss and the response simply goes unsaved, instead of failing the call.
+def _cache_get(key: str) -> str | None:
+    try:
+        with _CACHE_LOCK:
+            row = _cache_conn().execute("SELECT resp FROM cache WHERE k=?", (key,)).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def _cache_put(key: str, resp: str) -> None:
+    try:
+        with _CACHE_LOCK, _cache_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (k, resp) VALUES (?, ?)", (key, resp))
+    except sqlite3.Error:
+        pass
+
+
+def cache_deterministic(fn):
+    """
+    Memoize an acall_model-style coroutine function on disk when temperature is ~0.
+
+    Such calls are effectively pure functions of (model, prompt, max_tokens,
+    temperature, options), so repeats skip the API entirely. The sqlite lookups
+    run in a worker thread so disk I/O never blocks the event loop. Streaming
+    calls are never cached, since they print as they go.
+    """
+    @functools.wraps(fn)
+    async def wrapper(prompt: str, max_tokens: int = 1500, temperature: float = 0.4, **kwargs) -> str:
+        if temperature >= CACHE_MAX_TEMPERATURE or kwargs.get("stream"):
+            return await fn(prompt, max_tokens, temperature, **kwargs)
+        key = _cache_key(prompt, max_tokens, temperature, kwargs)
+        cached = await asyncio.to_thread(_cache_get, key)
+        if cached is not None:
+            return cached
+        resp = await fn(prompt, max_tokens, temperature, **kwargs)
+        await asyncio.to_thread(_cache_put, key, resp)
+        return resp
+
+    return wrapper
+
+
+class ModelRefusal(RuntimeError):
+    """The model declined a structured-output request instead of answering."""
+
+
+def _chat_request(prompt: str, model: str, max_tokens: int, temperature: float, **options) -> dict:
+    """
+    Build the body of a single-message chat completion.
+
+    Shared by live calls and Batch API lines so every request is shaped the
+    same way; options left as None (or False) are omitted.
+    """
+    request = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+    request.update({name: value for name, value in options.items() if value})
+    return request
+
+
+@cache_deterministic
+async def acall_model(
+    prompt: str,
+    max_tokens: int = 1500,
+    temperature: float = 0.4,
+    logit_bias: dict[int, int] | None = None,
+    stream: bool = False,
+    model: str = MODEL,
+    response_format: dict | None = None,
+) -> str:
+    """
+    Run a single-message chat completion and return the reply text.
+
+    With stream=True the reply is written to stdout as tokens arrive, so the
+    reader sees the story after the first token instead of the last one.
+    """
+    resp = await get_async_client().chat.completions.create(**_chat_request(
+        prompt, model, max_tokens, temperature,
+        logit_bias=logit_bias, stream=stream, response_format=response_format,
+    ))
+    if not stream:
+        message = resp.choices[0].message
+        if getattr(message, "refusal", None):
+            raise ModelRefusal(message.refusal)
+        return message.content or ""
+
+    buffer = []
+    async for chunk in resp:
+        content = chunk.choices[0].delta.content if chunk.choices else None
+        if content:
+            sys.stdout.write(content)
+            sys.stdout.flush()
+            buffer.append(content)
+    sys.stdout.write("\n")
+    return "".join(buffer)
 
 
 # --------------------------------------------------------
@@ -54,17 +264,54 @@ def estimate_word_target(length_minutes: float) -> int:
     return int(length_minutes * 150)
 
 
+# Token budgeting for story-writing calls (generate, revise, user feedback).
+TOKENS_PER_WORD = 1.35
+MAX_COMPLETION_TOKENS = 4096  # gpt-3.5-turbo output limit
+MAX_CONTEXT_TOKENS = 16000  # stay just under the 16,385-token context window
+
+
+def story_max_tokens(prompt: str, length_minutes: float) -> int:
+    """
+    Size the completion budget from the target story length.
+
+    Reserves ~30% headroom over the expected story tokens instead of a fixed
+    3000, and fails fast if prompt plus budget would overflow the context
+    window rather than letting the API reject the request.
+    """
+    target_tokens = int(estimate_word_target(length_minutes) * TOKENS_PER_WORD)
+    max_tokens = min(MAX_COMPLETION_TOKENS, max(400, int(target_tokens * 1.3)))
+    prompt_tokens = len(_encoding_for(MODEL_WRITER).encode(prompt))
+    if prompt_tokens + max_tokens >= MAX_CONTEXT_TOKENS:
+        raise RuntimeError(
+            f"Prompt ({prompt_tokens} tokens) plus story budget ({max_tokens} tokens) "
+            f"exceeds the {MAX_CONTEXT_TOKENS}-token context limit."
+        )
+    return max_tokens
+
+
 # --------------------------------------------------------
 # Simple categorizer so we can tailor the generation strategy
 # --------------------------------------------------------
+# Checked in order; the first category with any keyword in the request wins.
+CATEGORY_KEYWORDS = [
+    ("medical_comfort", ["doctor", "hospital", "nurse"]),
+    ("space_adventure", ["space", "planet", "rocket", "star"]),
+    ("animal_friendship", ["animal", "cat", "dog", "forest", "farm"]),
+]
+
+# One compiled alternation per category, so each category is a single C-level
+# scan of the request instead of one Python `in` check per keyword.
+_CATEGORY_PATTERNS = [
+    (category, re.compile("|".join(map(re.escape, keywords))))
+    for category, keywords in CATEGORY_KEYWORDS
+]
+
+
 def categorize_request(request: str) -> str:
     text = request.lower()
-    if "doctor" in text or "hospital" in text or "nurse" in text:
-        return "medical_comfort"
-    if "space" in text or "planet" in text or "rocket" in text or "star" in text:
-        return "space_adventure"
-    if "animal" in text or "cat" in text or "dog" in text or "forest" in text or "farm" in text:
-        return "animal_friendship"
+    for category, pattern in _CATEGORY_PATTERNS:
+        if pattern.search(text):
+            return category
     return "generic"
 
 # --------------------------------------------------------
@@ -82,8 +329,95 @@ SAFE_MORALS = [
     "Being patient and not giving up helps you grow.",
     "It is important to be yourself and accept who you are.",
     "Helping others when they need it is a good thing.",
+    "Curiosity helps us discover wonderful new things.",
 ]
 
+# Morals that fit each request category, so the storyteller does not have to
+# reconcile a mismatched moral and setting. Entries may repeat across categories.
+SAFE_MORALS_BY_CATEGORY = {
+    "medical_comfort": [
+        "It is okay to be afraid; courage means trying anyway.",
+        "Being patient and not giving up helps you grow.",
+        "Helping others when they need it is a good thing.",
+        "Kindness to others is important.",
+    ],
+    "space_adventure": [
+        "Curiosity helps us discover wonderful new things.",
+        "It is okay to be afraid; courage means trying anyway.",
+        "Friends help each other and work together.",
+        "Being patient and not giving up helps you grow.",
+    ],
+    "animal_friendship": [
+        "Taking care of the world and nature is important.",
+        "Kindness to others is important.",
+        "Friends help each other and work together.",
+        "Sharing and generosity make everyone happier.",
+    ],
+    "generic": SAFE_MORALS,
+}
+
+
+def pick_safe_moral(category: str) -> str:
+    return random.choice(SAFE_MORALS_BY_CATEGORY.get(category, SAFE_MORALS))
+
+
+def normalize_moral(moral: str) -> str:
+    return moral.strip().lower().rstrip(".!")
+
+
+# Morals parents commonly type, with a known verdict, so they can skip the
+# classifier entirely. Anything not listed still goes through the classifier.
+KNOWN_SAFE_MORALS = {normalize_moral(moral) for moral in SAFE_MORALS} | {
+    "be kind",
+    "kindness matters",
+    "share",
+    "sharing is caring",
+    "tell the truth",
+    "be honest",
+    "honesty is the best policy",
+    "be brave",
+    "be patient",
+    "never give up",
+    "don't give up",
+    "help others",
+    "be a good friend",
+    "work together",
+    "teamwork",
+    "be yourself",
+    "say sorry",
+    "say please and thank you",
+    "be grateful",
+    "take care of nature",
+    "it's okay to make mistakes",
+}
+
+KNOWN_UNSAFE_MORALS = {
+    "fight back",
+    "hit back",
+    "punish them",
+    "revenge is sweet",
+    "get revenge",
+    "never trust anyone",
+    "don't tell your parents",
+    "keep secrets from grown-ups",
+    "go with strangers",
+    "winning is everything",
+    "only the strong survive",
+    "crying is for babies",
+    "boys don't cry",
+    "it's your fault",
+}
+
+
+def known_moral_verdict(moral: str) -> bool | None:
+    """Return True/False for a known safe/unsafe moral, or None if unknown."""
+    normalized = normalize_moral(moral)
+    if normalized in KNOWN_UNSAFE_MORALS:
+        return False
+    if normalized in KNOWN_SAFE_MORALS:
+        return True
+    return None
+
 
 def ask_for_moral() -> str:
     """
@@ -97,43 +431,94 @@ def ask_for_moral() -> str:
     return moral
 
 
-def classify_moral_safety(moral: str, age: int) -> bool:
-    """
-    Use the LLM as a safety classifier for the requested moral.
+# The classifier answer is forced to a single token: the first token of either
+# "SAFE" or "UNSAFE". Nothing else can be sampled, so one decode step suffices
+# and the reply cannot drift into e.g. "SAFELY unsafe".
+# Token IDs are tokenizer-specific, so use the classifier model's encoding.
+@functools.cache
+def _verdict_tokens() -> tuple[dict[int, int], str]:
+    """Return the SAFE/UNSAFE logit bias and the decoded text of the SAFE token."""
+    enc = _encoding_for(MODEL_CLASSIFIER)
+    safe_token = enc.encode("SAFE")[0]
+    unsafe_token = enc.encode("UNSAFE")[0]
+    return {safe_token: 100, unsafe_token: 100}, enc.decode([safe_token])
+
+
+def _moral_safety_prompt(moral: str, age: int) -> str:
+    return f"""You classify morals for children's bedtime stories (ages 5–10).
+SAFE: promotes kindness, empathy, cooperation, honesty, curiosity, patience, courage,
+self-acceptance, responsibility, or gentle resilience.
+UNSAFE: encourages harm, hatred, exclusion, bullying, cruelty, risky or illegal behavior,
+unhealthy relationships, self-blame, extreme self-sacrifice, or anything psychologically
+harmful or confusing to a young child.
+
+CHILD AGE: {age}
+MORAL:
+\"\"\"{moral}\"\"\"
 
-    Returns True if SAFE, False if UNSAFE.
-    The model is instructed to answer with exactly 'SAFE' or 'UNSAFE'.
-    """
-    prompt = f"""
-    You are a safety and ethics classifier for children's bedtime story morals.
+Answer with exactly one word: SAFE or UNSAFE."""
+
+
+# Optional local classifier: point DREAMWEAVER_SAFETY_MODEL at a fine-tuned
+# sequence-classification checkpoint (e.g. DistilRoBERTa) with SAFE/UNSAFE
+# labels to classify morals on CPU instead of spending an API round-trip.
+# transformers/torch are only imported when this is configured.
+SAFETY_MODEL_PATH = os.getenv("DREAMWEAVER_SAFETY_MODEL")
+
+_LOCAL_CLASSIFIER = None
 
-    A parent has requested the following moral/lesson for a story intended for a child
-    who is {age} years old (between 5 and 10):
 
-    MORAL:
-    \"\"\"{moral}\"\"\"
+def _load_local_classifier():
+    global _LOCAL_CLASSIFIER
+    if _LOCAL_CLASSIFIER is None:
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
-    Your task:
-    - Decide if this moral is SAFE and AGE-APPROPRIATE for a 5–10 year old child.
-    - A safe moral should emphasize positive traits such as kindness, empathy,
-    cooperation, honesty, curiosity, patience, courage, self-acceptance,
-    responsibility, or gentle resilience.
-    - A moral is UNSAFE if it encourages harm, hatred, exclusion, bullying, cruelty,
-    risky or illegal behavior, unhealthy relationships, self-blame, extreme
-    self-sacrifice, or anything that could be psychologically harmful or confusing
-    to a young child.
+        tokenizer = AutoTokenizer.from_pretrained(SAFETY_MODEL_PATH)
+        model = AutoModelForSequenceClassification.from_pretrained(SAFETY_MODEL_PATH).eval()
+        labels = {label.upper(): idx for idx, label in model.config.id2label.items()}
+        if "SAFE" not in labels:
+            raise RuntimeError(
+                f"Safety model at {SAFETY_MODEL_PATH!r} has no SAFE label "
+                f"(labels: {list(model.config.id2label.values())})."
+            )
+        _LOCAL_CLASSIFIER = (tokenizer, model, labels["SAFE"])
+    return _LOCAL_CLASSIFIER
 
-    Return EXACTLY ONE WORD (no explanation):
-    Either:
-    SAFE
-    or
-    UNSAFE
+
+def _classify_moral_locally(moral: str, age: int) -> bool:
+    import torch
+
+    tokenizer, model, safe_idx = _load_local_classifier()
+    inputs = tokenizer(f"Age:{age}\nMoral:{moral}", truncation=True, max_length=128, return_tensors="pt")
+    with torch.no_grad():
+        logits = model(**inputs).logits
+    return int(logits.argmax(dim=-1)[0]) == safe_idx
+
+
+async def aclassify_moral_safety(moral: str, age: int) -> bool:
     """
-    result = call_model(prompt, max_tokens=5, temperature=0.0).strip().upper()
-    return result.startswith("SAFE")
+    Use the LLM as a safety classifier for the requested moral.
 
+    Returns True if SAFE, False if UNSAFE.
+    The model is instructed to answer with exactly 'SAFE' or 'UNSAFE'.
+    If DREAMWEAVER_SAFETY_MODEL is set, a local classifier is used instead.
+    """
+    if SAFETY_MODEL_PATH:
+        # Local inference is CPU-bound; keep it off the event loop.
+        return await asyncio.to_thread(_classify_moral_locally, moral, age)
+
+    verdict_bias, safe_text = _verdict_tokens()
+    result = await acall_model(
+        _moral_safety_prompt(moral, age),
+        max_tokens=1,
+        temperature=0.0,
+        logit_bias=verdict_bias,
+        model=MODEL_CLASSIFIER,
+    )
+    return result.strip() == safe_text
 
-def select_moral(user_moral: str, age: int) -> tuple[str, bool, str | None]:
+
+async def aselect_moral(user_moral: str, age: int, category: str) -> tuple[str, bool, str | None]:
     """
     Decide which moral to use.
 
@@ -143,226 +528,468 @@ def select_moral(user_moral: str, age: int) -> tuple[str, bool, str | None]:
         original_moral: the original user moral if overridden, else None
     """
     if not user_moral:
-        # No preference given; choose a safe moral at random
-        return random.choice(SAFE_MORALS), False, None
+        # No preference given; choose a safe moral for the category at random
+        return pick_safe_moral(category), False, None
+
+    is_safe = known_moral_verdict(user_moral)
+    if is_safe is None:
+        is_safe = await aclassify_moral_safety(user_moral, age)
+    return _moral_from_verdict(user_moral, is_safe, category)
 
-    is_safe = classify_moral_safety(user_moral, age)
+
+def _moral_from_verdict(user_moral: str, is_safe: bool, category: str) -> tuple[str, bool, str | None]:
     if is_safe:
         return user_moral, False, None
 
-    # Unsafe → choose safe random moral instead
-    safe_moral = random.choice(SAFE_MORALS)
+    # Unsafe → choose a safe moral for the category instead
+    safe_moral = pick_safe_moral(category)
     return safe_moral, True, user_moral
 
 
 # --------------------------------------------------------
 # Storyteller LLM – produces an initial draft
 # --------------------------------------------------------
-def generate_story(request: str,
-    age: int,
-    category: str,
-    length_minutes: float,
-    moral: str,
-) -> str:
-    target_words = estimate_word_target(length_minutes)
+def _story_details(age: int, length_minutes: float) -> str:
+    """
+    The per-story block appended after every STATIC_*_PREFIX.
 
-    prompt = f"""
-You are an expert fiction writer.
+    Built in one place so the dynamic tail is formatted identically in every
+    prompt and the static prefixes stay byte-for-byte unchanged.
+    """
+    return (
+        "\nSTORY DETAILS:\n"
+        f"CHILD AGE: {age}\n"
+        f"READ-ALOUD MINUTES: {length_minutes:.1f}\n"
+        f"TARGET WORDS: {estimate_word_target(length_minutes)}\n"
+    )
 
-Goal:
-Write a bedtime story appropriate for a child who is {age} years old (ages 5–10).
 
-USER REQUEST:
-\"\"\"{request}\"\"\"
+# Every prompt below is split into a static prefix (no interpolation) followed
+# by the per-story details, so the instruction text is byte-identical from one
+# request to the next. OpenAI only caches prompt prefixes of 1024+ tokens and
+# these prefixes are well under that (see prompt_budget.py), so no cache
+# discount is expected; the layout just keeps each prompt's shape stable.
+STATIC_GENERATE_PREFIX = """
+You are an expert fiction writer. Write a bedtime story for the child in STORY DETAILS below
+(ages 5–10), following the USER REQUEST and DESIRED MORAL / LESSON.
 
-CATEGORY: {category}
+Moral: show it, don't lecture. The main character learns it themselves through the challenge.
 
-DESIRED MORAL / LESSON:
-\"\"\"{moral}\"\"\"
+Length: about READ-ALOUD MINUTES read aloud, ~TARGET WORDS (±20%). Clear paragraphs, simple sentences.
 
-The story should clearly embody this moral through the actions, choices,
-and growth of the main character. Do not lecture; show the moral through the story. The main character should learn the moral themselves through the challenge.
+Content:
+- Imaginative characters and worlds, with sensory-rich descriptions the child can visualize.
+- The main character is a child: kind, curious, or brave, but not perfect. Trying is beautiful.
+- Focus on the character's inner journey, not external events.
 
-Story length requirements:
-- The story should take about {length_minutes:.1f} minutes to read aloud.
-- Aim for approximately {target_words} words total (±20% is okay).
-- Use clear paragraphs and simple sentence structures.
+Safety: no violence, scary imagery, injuries, blood, abuse, self-harm, or sexual content.
 
-Content requirements:
-- Create characters and worlds that will capture their imaginations and emotions.
-- Use sensory-rich descriptions so the child can visualize the scene.
-- The main character should be a child. THey should be kind, curious, or brave - but not perfect. Trying is beautiful.
-- The story is about the character's inner journey, not the external events.
+Structure (6 acts):
+1. Setup: the main character, what they care about, where they are, and what they want.
+2. Inciting incident: something small and unexpected sparks curiosity or tension.
+3. Rising action: they learn something new, meet someone helpful, and face a challenge.
+4. Climax: a moment of tension, insight, connection, and emotional discovery.
+5. Resolution: the challenge is resolved, giving closure and emphasizing THE MORAL.
+6. Sleepy landing: the world grows quiet, the pace slows, and the mood turns cozy to prime the child for sleep.
+"""
 
-Safety requirements:
-- Keep your target audience of young children firmly in mind.
-- No violence, no scary imagery, no injuries, no blood, no abuse, no self-harm, no sexual content.
 
-Story structure requirements:
-    Write the story in 6 acts:
+def _story_prompt(request: str,
+    age: int,
+    category: str,
+    length_minutes: float,
+    moral: str,
+) -> str:
+    return STATIC_GENERATE_PREFIX + _story_details(age, length_minutes) + f"""CATEGORY: {category}
+
+USER REQUEST:
+\"\"\"{request}\"\"\"
 
-    Act 1 — This part introduces: The main character (who they are, what they care about), Where they are (setting), What they want (desire)
-    Act 2 - The Inciting Incident: Something small changes. Something unexpected that sparks curiosity or tension. This gives the story momentum.
-    Act 3 - Rising Action: Here, the character: Learns something new, meets someone helpful, faces a challenge. The purpose is to grow the character and gently stimulate imagination.
-    Act 4 - The Turning Point/Climax: A moment of high tension. The moment of insight. The moment of connection. The moment of emotional discovery.
-    Act 5 - The Resolution: The challenge is resolved. The purpose is to give closure and to emphasize THE MORAL OF THE STORY.
-    Act 6 - The Denouement (The Sleepy Landing): A peaceful ladning where the world becomes quiet, the tone slows down, the atmosphere becomes cozy. The purpose is to physically prime the child's nervous system for sleep.
+DESIRED MORAL / LESSON:
+\"\"\"{moral}\"\"\"
 
 Write the full story now:
 """
-    return call_model(prompt, max_tokens=3000, temperature=0.35)
 
 
-# --------------------------------------------------------
-# Judge LLM – evaluates quality & safety and suggests improvements
-# --------------------------------------------------------
-def judge_story(story: str, age: int, length_minutes: float) -> str:
-    target_words = estimate_word_target(length_minutes)
+async def agenerate_story(request: str,
+    age: int,
+    category: str,
+    length_minutes: float,
+    moral: str,
+    stream: bool = False,
+) -> str:
+    prompt = _story_prompt(request, age, category, length_minutes, moral)
+    max_tokens = story_max_tokens(prompt, length_minutes)
+    return await acall_model(
+        prompt, max_tokens=max_tokens, temperature=0.35, stream=stream, model=MODEL_WRITER
+    )
 
-    prompt = f"""
-You are a strict, detail-oriented safety and quality classifier for children's bedtime stories.
-Your job is to evaluate whether a story is fully safe, age-appropriate, calming, and emotionally
-supportive for a child who is {age} years old (between 5 and 10).
 
-The story should take about {length_minutes:.1f} minutes to read aloud (~{target_words} words).
+async def agenerate_story_candidates(request: str,
+    age: int,
+    category: str,
+    length_minutes: float,
+    moral: str,
+    n: int,
+) -> list[str]:
+    """
+    Generate n alternative drafts in a single request.
 
-Evaluate the story according to the following clearly-defined metrics.
-For each category, provide a score from 1–10 (higher = safer / better / more appropriate).
+    The server decodes all n choices from one prompt prefill, so this costs one
+    round-trip instead of n.
+    """
+    prompt = _story_prompt(request, age, category, length_minutes, moral)
+    resp = await get_async_client().chat.completions.create(
+        **_chat_request(prompt, MODEL_WRITER, story_max_tokens(prompt, length_minutes), 0.35, n=n)
+    )
+    return [choice.message.content or "" for choice in resp.choices]
 
-SAFETY & QUALITY METRICS:
 
-1. age_appropriateness
-   - Is the language, theme, and content suitable for ages 5–10?
+# Words that should never appear in a bedtime story; any hit sends the draft
+# to the judge even if it is otherwise the best candidate.
+UNSAFE_WORDS = re.compile(
+    r"\b(blood\w*|guns?|kill\w*|die[sd]?|dying|dead|weapons?|knife|knives|scream\w*|monsters?|injur\w*)\b",
+    re.IGNORECASE,
+)
+LENGTH_TOLERANCE = 0.2
 
-2. violence_safety
-   - No harm, danger, threats, weapons, physical conflict, or injuries.
 
-3. fear_safety
-   - No scary imagery, dark tension, frightening creatures, or anxiety-inducing scenes.
+def pick_draft(drafts: list[str], target_words: int) -> tuple[str, bool]:
+    """
+    Pick the best draft using cheap local checks.
 
-4. medical_safety
-   - No medical advice, diagnoses, procedures, or descriptions of illness/injury.
+    Drafts are ranked by distance from the target word count, with a penalty
+    per blocklisted word. Returns the best draft and whether it is clean: no
+    blocklisted words and within ±20% of the target length.
+    """
+    def score(draft: str) -> tuple[float, bool]:
+        deviation = abs(len(draft.split()) - target_words) / target_words
+        hits = len(UNSAFE_WORDS.findall(draft))
+        return -deviation - 0.5 * hits, hits == 0 and deviation <= LENGTH_TOLERANCE
 
-5. emotional_tone
-   - Calm, gentle, reassuring emotional atmosphere.
+    best = max(drafts, key=lambda draft: score(draft)[0])
+    return best, score(best)[1]
 
-6. language_complexity
-   - Simple vocabulary, short sentences, concrete imagery appropriate for ages 5–10.
 
-7. social_safety
-   - No bullying, humiliation, exclusion, stereotypes, or harmful interpersonal behavior.
+def batch_generate_stories(requests: list[dict], poll_seconds: float = 30.0) -> list[str]:
+    """
+    Generate many first drafts through the OpenAI Batch API (half price, async).
 
-8. real_world_safety
-   - No encouragement of unsafe behaviors (wandering alone at night, climbing dangerous places).
+    Each item holds the agenerate_story arguments: request, age, category,
+    length_minutes and moral. Blocks until the batch finishes (up to the 24h
+    completion window) and returns the drafts in input order. Meant for bulk
+    and evaluation runs, not the interactive CLI.
+    """
+    client = get_client()
+    lines = []
+    for i, item in enumerate(requests):
+        prompt = _story_prompt(
+            item["request"], item["age"], item["category"], item["length_minutes"], item["moral"]
+        )
+        lines.append(json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": _chat_request(
+                prompt, MODEL_WRITER, story_max_tokens(prompt, item["length_minutes"]), 0.35
+            ),
+        }))
+
+    batch_file = client.files.create(
+        file=("stories.jsonl", "\n".join(lines).encode()), purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_seconds)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Story batch {batch.id} ended with status {batch.status!r}.")
+
+    stories: list[str | None] = [None] * len(requests)
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        result = json_loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            raise RuntimeError(f"Story {result['custom_id']} failed in batch {batch.id}: {result.get('error')}")
+        stories[int(result["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+
+    missing = [i for i, story in enumerate(stories) if story is None]
+    if missing:
+        raise RuntimeError(f"Batch {batch.id} returned no output for stories {missing}.")
+    return stories  # type: ignore[return-value]
 
-9. sensory_safety
-   - Avoids overstimulating sensory descriptions (chaos, loud noises, fast danger, flashing lights).
 
-10. moral_clarity
-    - The story reinforces positive social-emotional lessons suitable for young children.
+# --------------------------------------------------------
+# Judge LLM – evaluates quality & safety and suggests improvements
+# --------------------------------------------------------
+# The 12-metric rubric, shared by the judge and the fused judge-and-revise prompt.
+JUDGE_METRICS = """METRICS (score 1–10, higher = safer / better):
+1. age_appropriateness: language, theme, and content suit ages 5–10.
+2. violence_safety: no harm, danger, threats, weapons, physical conflict, or injuries.
+3. fear_safety: no scary imagery, dark tension, frightening creatures, or anxiety.
+4. medical_safety: no medical advice, diagnoses, procedures, or illness/injury descriptions.
+5. emotional_tone: calm, gentle, reassuring.
+6. language_complexity: simple vocabulary, short sentences, concrete imagery.
+7. social_safety: no bullying, humiliation, exclusion, stereotypes, or harmful behavior.
+8. real_world_safety: no unsafe behaviors (wandering alone at night, climbing dangerous places).
+9. sensory_safety: no overstimulation (chaos, loud noises, fast danger, flashing lights).
+10. moral_clarity: reinforces positive social-emotional lessons.
+11. ending_serenity: ends on a peaceful, calming bedtime image.
+12. length_match: roughly ~TARGET WORDS (±20%).
+"""
 
-11. ending_serenity
-    - Ends with a peaceful, calming image appropriate for bedtime.
+STATIC_JUDGE_PREFIX = """
+You are a strict safety and quality judge for children's bedtime stories. Evaluate whether the
+STORY TO EVALUATE below is safe, age-appropriate, calming, and emotionally supportive for the
+child in STORY DETAILS (ages 5–10) and fits READ-ALOUD MINUTES (~TARGET WORDS).
 
-12. length_match
-    - Does the story roughly match the intended length (~{target_words} words ±20%)?
+""" + JUDGE_METRICS + """
+Return JSON with:
+- "scores": each metric's score, keyed by metric name.
+- "improvements": short, specific fixes to make the story clearer, more soothing, safer,
+  and closer to the target length (if needed).
 
-RETURN FORMAT:
+Do NOT rewrite the story; only critique it.
+"""
 
-A. A list of scores (1–10) for each metric in the order above.
-B. A short bullet list of specific improvements to make the story:
-   - clearer,
-   - more soothing,
-   - safer across all metrics,
-   - and closer to the intended length (if needed).
+JUDGE_METRIC_NAMES = [
+    "age_appropriateness",
+    "violence_safety",
+    "fear_safety",
+    "medical_safety",
+    "emotional_tone",
+    "language_complexity",
+    "social_safety",
+    "real_world_safety",
+    "sensory_safety",
+    "moral_clarity",
+    "ending_serenity",
+    "length_match",
+]
 
-Do NOT rewrite the story; only critique it.
+# Structured output keeps the judge reply compact and machine-readable.
+JUDGE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "story_judgement",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "scores": {
+                    "type": "object",
+                    "properties": {name: {"type": "integer"} for name in JUDGE_METRIC_NAMES},
+                    "required": JUDGE_METRIC_NAMES,
+                    "additionalProperties": False,
+                },
+                "improvements": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["scores", "improvements"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Structured Outputs (json_schema) is not available on these models; they get
+# plain JSON mode instead, which the "Return JSON" instruction above satisfies.
+JSON_SCHEMA_UNSUPPORTED_MODELS = ("gpt-3.5-turbo", "gpt-4-", "gpt-4o-2024-05-13")
+
+
+def _judge_response_format(model: str) -> dict:
+    if model == "gpt-4" or model.startswith(JSON_SCHEMA_UNSUPPORTED_MODELS):
+        return {"type": "json_object"}
+    return JUDGE_RESPONSE_FORMAT
+
+
+# A story scoring at least this on every metric is good enough to skip revision.
+JUDGE_PASS_SCORE = 8
+
+
+async def ajudge_story(story: str, age: int, length_minutes: float) -> str:
+    """
+    Return the judge's verdict as a JSON string (see JUDGE_RESPONSE_FORMAT).
 
+    Raises ModelRefusal if the judge declines to score the story.
+    """
+    prompt = STATIC_JUDGE_PREFIX + _story_details(age, length_minutes) + f"""
 STORY TO EVALUATE:
 \"\"\"{story}\"\"\"
 """
 
-    return call_model(prompt, temperature=0.2)
+    return await acall_model(
+        prompt, temperature=0.2, model=MODEL_JUDGE, response_format=_judge_response_format(MODEL_JUDGE)
+    )
+
+
+def format_judgement(judgement: dict) -> str:
+    lines = [f"{name}: {score}/10" for name, score in judgement["scores"].items()]
+    lines += ["", "Improvements:"] + [f"- {item}" for item in judgement["improvements"]]
+    return "\n".join(lines)
 
 
 # --------------------------------------------------------
 # Revision step – storyteller revises based on judge feedback
 # --------------------------------------------------------
-def revise_story(original_story: str, judge_feedback: str, age: int, length_minutes: float) -> str:
-    target_words = estimate_word_target(length_minutes)
+# Repair rules shared by the revision and fused judge-and-revise prompts.
+REPAIR_RULES = """Rules:
+- Delete unsafe scenes entirely (violence, fear, unsafe behavior, medical content or injury,
+  bullying, overstimulation, adult concepts) and rewrite those parts so the story still flows.
+- Replace unsafe elements with soft, gentle, friendly, or magical alternatives; keep the plot
+  intent, not the unsafe details.
+- Keep a calm, soothing tone and simple language throughout.
+- End on a peaceful, comforting bedtime moment.
+- Aim for ~TARGET WORDS.
+
+Output ONLY the revised story: no explanations, notes, scores, or preamble.
+"""
 
-    prompt = prompt = f"""
+STATIC_REVISE_PREFIX = """
 You are a strict safety censor and story repair specialist for children's bedtime stories.
+Treat the JUDGE FEEDBACK below as authoritative: remove everything it flags and rewrite the
+ORIGINAL STORY so it is fully safe and calming for the child in STORY DETAILS (ages 5–10),
+at about READ-ALOUD MINUTES (~TARGET WORDS).
 
-Your job is to REMOVE any unsafe, inappropriate, overstimulating, frightening,
-medically inappropriate, socially harmful, or age-inappropriate content flagged
-by the judge, and REWRITE the story so it is fully safe, calming, and suitable
-for a child who is {age} years old (ages 5–10).
-
-The story should be about {length_minutes:.1f} minutes (~{target_words} words).
+""" + REPAIR_RULES
 
-You must treat the judge feedback as authoritative safety requirements.
 
+async def arevise_story(
+    original_story: str,
+    judge_feedback: str,
+    age: int,
+    length_minutes: float,
+    stream: bool = False,
+) -> str:
+    prompt = STATIC_REVISE_PREFIX + _story_details(age, length_minutes) + f"""
 JUDGE FEEDBACK (must be fully addressed):
 \"\"\"{judge_feedback}\"\"\"
 
 ORIGINAL STORY:
 \"\"\"{original_story}\"\"\"
 
-YOUR TASK:
-- Strictly censor ALL content identified as unsafe or inappropriate by the judge.
-- Delete unsafe scenes entirely, not partially.
-- Rewrite missing or removed sections so the story still flows smoothly and logically.
-- Maintain a calm, soothing emotional tone throughout.
-- Keep the story clearly appropriate for ages 5–10.
-- Ensure there is:
-  - NO violence or harm,
-  - NO fear or frightening imagery,
-  - NO unsafe real-world behaviors,
-  - NO medical advice, illness, or injuries,
-  - NO bullying or negative social behavior,
-  - NO sensory overstimulation,
-  - NO complex adult concepts.
-- Replace unsafe elements with soft, gentle, friendly, or magical alternatives.
-- Preserve the overall plot intent WITHOUT preserving unsafe details.
-- End the story with a peaceful, comforting bedtime-appropriate moment.
-- Aim for the target length (~{target_words} words).
-
-OUTPUT INSTRUCTIONS:
-Write the FULLY REVISED STORY below, containing ONLY safe, calm,
-emotionally warm content suitable for a bedtime story for ages 5–10.
-
-Do NOT explain your changes. Do NOT include notes. ONLY output the revised story.
+Write the fully revised story now:
 """
 
-    return call_model(prompt, max_tokens=3000, temperature=0.35)
+    max_tokens = story_max_tokens(prompt, length_minutes)
+    return await acall_model(
+        prompt, max_tokens=max_tokens, temperature=0.35, stream=stream, model=MODEL_WRITER
+    )
 
 
 # --------------------------------------------------------
-# Optional: apply direct user feedback for a final refinement
+# Fused judge + revision – one round-trip instead of two
 # --------------------------------------------------------
-def apply_user_feedback(current_story: str, feedback: str, age: int, length_minutes: float) -> str:
-    target_words = estimate_word_target(length_minutes)
+STATIC_JUDGE_AND_REVISE_PREFIX = """
+You are a strict safety reviewer and story repair specialist for children's bedtime stories.
+First, silently score the ORIGINAL STORY below for the child in STORY DETAILS (ages 5–10),
+at about READ-ALOUD MINUTES (~TARGET WORDS):
+
+""" + JUDGE_METRICS + """
+Then rewrite the story so it scores highly on every metric.
+
+""" + REPAIR_RULES
+
+
+async def ajudge_and_revise(story: str, age: int, length_minutes: float, stream: bool = False) -> str:
+    """
+    Critique and rewrite in a single call.
+
+    Replaces ajudge_story followed by arevise_story on the default path: one
+    prompt and one round-trip, and the story is only sent to the model once.
+    """
+    prompt = STATIC_JUDGE_AND_REVISE_PREFIX + _story_details(age, length_minutes) + f"""
+ORIGINAL STORY:
+\"\"\"{story}\"\"\"
+
+Write the revised story now:
+"""
 
-    prompt = f"""
-You will refine a children's bedtime story based on user feedback.
+    max_tokens = story_max_tokens(prompt, length_minutes)
+    return await acall_model(
+        prompt, max_tokens=max_tokens, temperature=0.35, stream=stream, model=MODEL_WRITER
+    )
 
-Child age: {age} (between 5 and 10)
-Target: {length_minutes:.1f} minutes (~{target_words} words).
 
+# --------------------------------------------------------
+# Optional: apply direct user feedback for a final refinement
+# --------------------------------------------------------
+STATIC_FEEDBACK_PREFIX = """
+Revise the children's bedtime story below to incorporate the user feedback in a way that suits
+the child in STORY DETAILS (ages 5–10). Add nothing scary, violent, or medically inappropriate.
+Keep about the same length (~TARGET WORDS, ±20%).
+"""
+
+
+async def aapply_user_feedback(current_story: str, feedback: str, age: int, length_minutes: float) -> str:
+    prompt = STATIC_FEEDBACK_PREFIX + _story_details(age, length_minutes) + f"""
 Current story:
 \"\"\"{current_story}\"\"\"
 
 User feedback:
 \"\"\"{feedback}\"\"\"
 
-Revise the story to incorporate the feedback in an age-appropriate way.
-Do not add anything scary, violent, or medically inappropriate.
-Keep the story approximately the same length (around {target_words} words, ±20%).
-
 Write the final story:
 """
-    return call_model(prompt, max_tokens=3000, temperature=0.4)
+    max_tokens = story_max_tokens(prompt, length_minutes)
+    return await acall_model(prompt, max_tokens=max_tokens, temperature=0.4, model=MODEL_WRITER)
+
+
+# --------------------------------------------------------
+# Semantic story cache – reuse a finished story for a near-identical request
+# --------------------------------------------------------
+# Disable with DREAMWEAVER_STORY_CACHE=0 to always write a fresh story.
+STORY_CACHE_ENABLED = os.getenv("DREAMWEAVER_STORY_CACHE", "1") != "0"
+EMBEDDING_MODEL = "text-embedding-3-small"
+STORY_CACHE_MIN_SIMILARITY = 0.92
+STORY_CACHE_MAX_LENGTH_DIFF = 1.5
+
+
+async def aembed_request(request: str) -> array.array:
+    """Embed a story request as a unit-length float32 vector."""
+    resp = await get_async_client().embeddings.create(model=EMBEDDING_MODEL, input=request)
+    vector = resp.data[0].embedding
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return array.array("f", (x / norm for x in vector))
+
+
+def find_cached_story(
+    embedding: array.array, age: int, length_minutes: float, moral: str
+) -> tuple[str, str] | None:
+    """
+    Return the closest stored story for the same age and requested moral with
+    a similar length, if its request embedding is similar enough, together
+    with the moral it was written with.
+
+    Rows are narrowed in SQL first, so the cosine scan only sees a handful of
+    candidates and a plain dot product over unit vectors is enough.
+    """
+    with _CACHE_LOCK:
+        rows = _cache_conn().execute(
+            "SELECT embedding, story, selected_moral FROM stories "
+            "WHERE age=? AND moral=? AND ABS(length_minutes - ?) < ?",
+            (age, moral, length_minutes, STORY_CACHE_MAX_LENGTH_DIFF),
+        ).fetchall()
+    best, best_similarity = None, STORY_CACHE_MIN_SIMILARITY
+    for blob, story, selected_moral in rows:
+        similarity = sum(a * b for a, b in zip(embedding, array.array("f", blob)))
+        if similarity > best_similarity:
+            best, best_similarity = (story, selected_moral), similarity
+    return best
+
+
+def store_story(
+    embedding: array.array, age: int, length_minutes: float, moral: str, selected_moral: str, story: str
+) -> None:
+    with _CACHE_LOCK, _cache_conn() as conn:
+        conn.execute(
+            "INSERT INTO stories (age, length_minutes, moral, embedding, story, selected_moral) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (age, length_minutes, moral, embedding.tobytes(), story, selected_moral),
+        )
 
 
 # --------------------------------------------------------
@@ -382,17 +1009,74 @@ def ask_for_age() -> int:
             print("Please enter a valid number.")
 
 
+async def run_prompt(fn, *args):
+    """
+    Run a blocking prompt (input() loop) without blocking the event loop, so
+    background network work can proceed while the user types.
+
+    Uses a daemon thread rather than asyncio.to_thread so Ctrl-C exits
+    immediately instead of waiting for a pending input() to return.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def target():
+        try:
+            result = fn(*args)
+        except BaseException as exc:
+            loop.call_soon_threadsafe(future.set_exception, exc)
+        else:
+            loop.call_soon_threadsafe(future.set_result, result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return await future
+
+
+async def awarm_clients() -> None:
+    """Open API connections (DNS, TCP, TLS) while the user is still typing."""
+    try:
+        await get_async_client().models.list()
+    except Exception:
+        # Best effort only; the first real call reports any actual problem.
+        pass
+
+
 # --------------------------------------------------------
 # Main CLI flow
 # --------------------------------------------------------
-def main():
-    print("=== Hippocratic AI Bedtime Story Engine ===")
-    age = ask_for_age()
-    length_minutes = ask_for_length_minutes()
-    user_request = input("What kind of story would you like? ")
+async def awrite_story(
+    user_request: str,
+    age: int,
+    category: str,
+    length_minutes: float,
+    user_moral: str,
+    explain: bool = False,
+    candidates: int = 1,
+) -> tuple[str, str, bool, bool]:
+    """
+    Run moral selection, draft, judge and revision, printing each stage.
+
+    With explain=True the judge and revision run as separate calls and the
+    judge feedback is printed; otherwise they are fused into one call.
 
-    user_moral = ask_for_moral()
-    selected_moral, overridden, original_moral = select_moral(user_moral, age)
+    With candidates > 1, that many drafts are generated in one request and the
+    best is picked locally; if it passes the local checks the judge is skipped
+    (except with explain=True).
+
+    Returns the revised story, the moral it was written with, whether the
+    requested moral was overridden, and whether the story went to the judge.
+    """
+    if user_moral and known_moral_verdict(user_moral) is None:
+        # Most requested morals are safe, so draft with the requested moral while
+        # the classifier runs. The speculative draft is discarded if it is unsafe.
+        # Known morals need no classifier, so they skip straight to a streamed draft.
+        (selected_moral, overridden, original_moral), drafts = await asyncio.gather(
+            aselect_moral(user_moral, age, category),
+            agenerate_story_candidates(user_request, age, category, length_minutes, user_moral, candidates),
+        )
+    else:
+        selected_moral, overridden, original_moral = await aselect_moral(user_moral, age, category)
+        drafts = None
 
     if overridden:
         print("\n[DISCLAIMER]")
@@ -405,34 +1089,139 @@ def main():
     else:
         print(f"\nUsing moral: {selected_moral!r}\n")
 
-    category = categorize_request(user_request)
-
     # 1) First draft
-    draft = generate_story(user_request, age, category, length_minutes, selected_moral)
     print("\n--- FIRST DRAFT ---\n")
-    print(draft)
+    clean = False
+    if (drafts is None or overridden) and candidates == 1:
+        draft = await agenerate_story(
+            user_request, age, category, length_minutes, selected_moral, stream=True
+        )
+    else:
+        if drafts is None or overridden:
+            drafts = await agenerate_story_candidates(
+                user_request, age, category, length_minutes, selected_moral, candidates
+            )
+        # Speculative drafts could not be shown until the moral was cleared.
+        draft, clean = pick_draft(drafts, estimate_word_target(length_minutes))
+        print(draft)
+
+    if candidates > 1 and clean and not explain:
+        print(f"\n(Best of {candidates} drafts passed the local checks; skipping the judge.)")
+        return draft, selected_moral, overridden, False
+
+    if not explain:
+        # 2+3) Judge and revise in a single call
+        print("\n--- REVISED STORY ---\n")
+        revised = await ajudge_and_revise(draft, age, length_minutes, stream=True)
+        return revised, selected_moral, overridden, True
 
     # 2) Judge feedback
-    feedback = judge_story(draft, age, length_minutes)
+    try:
+        feedback = await ajudge_story(draft, age, length_minutes)
+        judgement = json_loads(feedback)
+        # JSON mode does not enforce the schema, so scores may arrive as strings.
+        judgement["scores"] = {name: int(score) for name, score in judgement["scores"].items()}
+        report, lowest = format_judgement(judgement), min(judgement["scores"].values())
+    except (ModelRefusal, ValueError, KeyError, TypeError, AttributeError):
+        # A refusal or malformed verdict leaves nothing to show; still revise.
+        print("\n(The judge returned no usable feedback; judging and revising in one step instead.)")
+        print("\n--- REVISED STORY ---\n")
+        revised = await ajudge_and_revise(draft, age, length_minutes, stream=True)
+        return revised, selected_moral, overridden, True
     print("\n--- SAFETY CLASSIFIER FEEDBACK ---\n")
-    print(feedback)
+    print(report)
+
+    if lowest >= JUDGE_PASS_SCORE:
+        print(f"\nEvery metric scored {JUDGE_PASS_SCORE}+; keeping the first draft.")
+        return draft, selected_moral, overridden, True
 
     # 3) Revised story
-    revised = revise_story(draft, feedback, age, length_minutes)
     print("\n--- REVISED STORY ---\n")
-    print(revised)
+    revised = await arevise_story(draft, feedback, age, length_minutes, stream=True)
+    return revised, selected_moral, overridden, True
+
+
+async def amain(explain: bool = False, candidates: int = 1):
+    print("=== Hippocratic AI Bedtime Story Engine ===")
+    warmup = asyncio.create_task(awarm_clients())
+    age = await run_prompt(ask_for_age)
+    length_minutes = await run_prompt(ask_for_length_minutes)
+    user_request = await run_prompt(input, "What kind of story would you like? ")
+    category = categorize_request(user_request)
+
+    # Embed the request for the story cache while the moral is being typed.
+    embedding_task = asyncio.create_task(aembed_request(user_request)) if STORY_CACHE_ENABLED else None
+    user_moral = await run_prompt(ask_for_moral)
+
+    # 0) Reuse the story from an equivalent earlier request. Stories are only
+    # stored when the requested moral was kept, so a hit needs no moral check.
+    embedding, cached = None, None
+    if embedding_task is not None:
+        try:
+            embedding = await embedding_task
+            cached = await asyncio.to_thread(find_cached_story, embedding, age, length_minutes, user_moral)
+        except Exception:
+            # The cache is an optimization; any failure is treated as a miss
+            # and the new story is not stored.
+            embedding = None
+
+    if cached is not None:
+        revised, selected_moral = cached
+        print(f"\nUsing moral: {selected_moral!r}\n")
+        if explain:
+            print("(Reusing a story that was already judged and revised; no new feedback to show.)")
+        print("\n--- STORY (from an earlier matching request) ---\n")
+        print(revised)
+    else:
+        revised, selected_moral, overridden, judged = await awrite_story(
+            user_request, age, category, length_minutes, user_moral, explain=explain, candidates=candidates
+        )
+        # Only judged stories are reused, so a cache hit never skips the judge.
+        if embedding is not None and not overridden and judged:
+            try:
+                await asyncio.to_thread(
+                    store_story, embedding, age, length_minutes, user_moral, selected_moral, revised
+                )
+            except sqlite3.Error:
+                # Not saving the story only costs a future cache hit.
+                pass
 
     # 4) Optional user refinement
-    user_notes = input("\nWould you like any changes? ").strip()
+    user_notes = (await run_prompt(input, "\nWould you like any changes? ")).strip()
 
     if user_notes:
-        final_story = apply_user_feedback(revised, user_notes, age, length_minutes)
+        final_story = await aapply_user_feedback(revised, user_notes, age, length_minutes)
         print("\n--- FINAL STORY ---\n")
         print(final_story)
     else:
         print("\n--- FINAL STORY ---\n")
         print(revised)
 
+    # Warm-up is never awaited: a slow models.list() must not hold up the
+    # story, and real calls share the pool it is opening anyway.
+    warmup.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a safe bedtime story for ages 5–10.")
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="run the judge and revision as separate steps and show the judge feedback",
+    )
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=1,
+        metavar="N",
+        help="draft N stories in one request and pick the best locally; "
+        "the judge is skipped when the pick passes the local checks",
+    )
+    args = parser.parse_args()
+    if args.candidates < 1:
+        parser.error("--candidates must be at least 1")
+    asyncio.run(amain(explain=args.explain, candidates=args.candidates))
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
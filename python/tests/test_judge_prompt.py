@@ -0,0 +1,25 @@
+import hashlib
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("tiktoken")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import story_engine as se  # noqa: E402
+
+# The judge rubric is pinned so judge scores stay comparable across runs.
+# If a change to it is intended, update the hash in the same commit.
+PINNED_SHA256 = {
+    "STATIC_JUDGE_PREFIX": "f8d731c52192938caf374ea367d7fcdb504c5b9f0767a7bdd109f7df3ab26cce",
+    "JUDGE_METRICS": "a5ea98b27a61a986b1a4664f8554a599b1e38d2a4aa11ed290ed448a41601f66",
+}
+
+
+@pytest.mark.parametrize("name", sorted(PINNED_SHA256))
+def test_judge_prompt_unchanged(name):
+    digest = hashlib.sha256(getattr(se, name).encode()).hexdigest()
+    assert digest == PINNED_SHA256[name], f"{name} changed; update PINNED_SHA256 if intended"
@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("tiktoken")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import prompt_budget  # noqa: E402
+
+
+@pytest.mark.parametrize("name", sorted(prompt_budget.PREFIXES))
+def test_prefix_within_budget(name):
+    text, model, budget = prompt_budget.PREFIXES[name]
+    try:
+        tokens = prompt_budget.count_tokens(text, model)
+    except Exception as exc:
+        # tiktoken downloads encodings on first use.
+        pytest.skip(f"encoding for {model} unavailable: {exc}")
+    assert tokens <= budget, f"{name} is {tokens} tokens, over its {budget}-token budget"